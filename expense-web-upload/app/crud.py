@@ -1,75 +1,241 @@
 from __future__ import annotations
 
+import os
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import date, timedelta
+from decimal import Decimal
 from typing import List, Dict, Optional, Any, Tuple
 
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, desc, case, select, insert, delete, bindparam, true, Numeric, Row
 
 from app.models import Record, User
 
 
+_RECENT_ORDER = (desc(Record.r_date), desc(Record.id))
+
+_ZERO = Decimal("0.00")
+
+
+# ---------- Prebuilt statements ----------
+# 热路径上的 select 在 import 时建好，只在调用时绑参数：
+# 不用每次重新拼 Select，SQLAlchemy 的编译缓存也一直命中同一个 key
+def _money_sum(r_type: str):
+    # 在 SQL 里就 ROUND 到分并按 Numeric 取回（Decimal）：
+    # SQLite 里 amount 实际按浮点存，累加出的 0.30000000000000004 在库里就被抹掉，Python 侧不再 round/format
+    return func.round(
+        func.coalesce(func.sum(case((Record.r_type == r_type, Record.amount), else_=0)), 0),
+        2,
+        type_=Numeric(12, 2),
+    )
+
+
+_RANGE_FILTER = (
+    Record.user_id == bindparam("uid"),
+    Record.r_date >= bindparam("start"),
+    Record.r_date <= bindparam("end"),
+)
+
+# 首页：最近 n 条 + 区间汇总一次查完。汇总是不带 GROUP BY 的聚合子查询，恰好一行，
+# CROSS JOIN 到列表的每一行上（数据库只算一次），省掉第二次往返
+_HOME_SUMS = (
+    select(
+        _money_sum("expense").label("sum_expense"),
+        _money_sum("income").label("sum_income"),
+    )
+    .where(*_RANGE_FILTER)
+    .subquery("sums")
+)
+
+_HOME_STMT = (
+    # 列名按模板的叫法起别名：r.date / r.type
+    select(
+        Record.id,
+        Record.r_date.label("date"),
+        Record.r_type.label("type"),
+        Record.amount,
+        Record.category,
+        Record.note,
+        _HOME_SUMS.c.sum_expense,
+        _HOME_SUMS.c.sum_income,
+    )
+    .join_from(Record, _HOME_SUMS, true())
+    .where(Record.user_id == bindparam("uid"))
+    .order_by(*_RECENT_ORDER)
+    .limit(bindparam("lim"))
+)
+
+
+# ---------- Caches ----------
+# 记录每写一次 _data_version 就 +1。缓存 key 带着版本号：写入后旧条目不会再被命中，
+# 写入时正在算的那次查询也只会存到旧版本下，不会把旧数据塞进新版本。
+# 多 worker 时别的进程感知不到这里的写入，所以再加一个短 TTL 兜底
+_data_version = 0
+
+
+def _env_ttl(name: str, default: str) -> float:
+    # TTL 设 0 就是关掉对应的缓存（和 ETag）；不是数字或为负直接在启动时报错
+    raw = os.getenv(name, default)
+    try:
+        ttl = float(raw)
+    except ValueError:
+        raise ValueError(f"{name} must be a number of seconds, got {raw!r}") from None
+    if not 0 <= ttl < float("inf"):
+        raise ValueError(f"{name} must be a finite number >= 0, got {raw!r}")
+    return ttl
+
+
+STATS_CACHE_SIZE = 256
+STATS_CACHE_TTL = _env_ttl("STATS_CACHE_TTL", "60")
+_STATS_CACHE: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()
+
+# 首页被刷得最勤，TTL 给短一点
+HOME_CACHE_SIZE = 64
+HOME_CACHE_TTL = _env_ttl("HOME_CACHE_TTL", "5")
+_HOME_CACHE: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()
+
+
+def _cache_get(cache: OrderedDict, key: tuple, ttl: float) -> Any:
+    hit = cache.get(key)
+    if hit is not None and time.monotonic() - hit[0] < ttl:
+        cache.move_to_end(key)
+        return hit[1]
+    return None
+
+
+def _cache_put(cache: OrderedDict, key: tuple, value: Any, size: int) -> None:
+    cache[key] = (time.monotonic(), value)
+    if len(cache) > size:
+        cache.popitem(last=False)
+
+
+# 进程启动标记：重启后 _data_version 从 0 重新数，带上它 ETag 才不会和重启前的撞上
+_BOOT = os.urandom(4).hex()
+
+
+def data_tag(ttl: float = STATS_CACHE_TTL) -> Optional[str]:
+    # 给 HTTP 条件请求用的数据版本。本进程的写入立刻生效；别的 worker 的写入感知不到，
+    # 所以再带上按 ttl 划分的时间片，最多旧这么久（和对应的数据缓存一致）。
+    # ttl 为 0 表示缓存关了：返回 None，调用方就不发 ETag、也不回 304
+    if ttl <= 0:
+        return None
+    return f"{_BOOT}.{_data_version}.{int(time.time() // ttl)}"
+
+
+def mark_records_changed() -> None:
+    # Record 有增删改之后调用（提交之后）
+    global _data_version
+    _data_version += 1
+    _STATS_CACHE.clear()
+    _HOME_CACHE.clear()
+
+
 # ---------- Users ----------
-def get_user_by_username(db: Session, username: str) -> Optional[User]:
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[User]:
+    return (await db.execute(select(User).where(User.username == username))).scalars().first()
 
 
-def create_user(db: Session, username: str, password_hash: str, phone: Optional[str] = None) -> User:
-    u = User(username=username, password_hash=password_hash, phone=phone)
+async def list_users(db: AsyncSession, limit: int = 200) -> List[User]:
+    return (await db.execute(select(User).order_by(User.id.desc()).limit(limit))).scalars().all()
+
+
+async def update_user_password(db: AsyncSession, user_id: int, password_hash: str) -> None:
+    u = await db.get(User, user_id)
+    if not u:
+        return
+    u.password_hash = password_hash
+    await db.commit()
+
+
+async def create_user(db: AsyncSession, username: str, password_hash: str) -> User:
+    u = User(username=username, password_hash=password_hash)
     db.add(u)
-    db.commit()
-    db.refresh(u)
+    await db.commit()
+    await db.refresh(u)
     return u
 
 
 # ---------- Records ----------
-def list_records(db: Session, user_id: int, limit: int = 200) -> List[Record]:
-    return (
-        db.query(Record)
-        .filter(Record.user_id == user_id)
-        .order_by(desc(Record.date), desc(Record.id))
-        .limit(limit)
-        .all()
-    )
-
-
-def create_record(
-    db: Session,
+async def create_record(
+    db: AsyncSession,
     user_id: int,
     type_: str,
-    amount: float,
+    amount: Decimal,
     category: str,
     d: date,
     note: str = "",
 ) -> Record:
     obj = Record(
         user_id=user_id,
-        type=type_,
-        amount=float(amount),
+        r_type=type_,
+        amount=amount,
         category=category,
-        date=d,
+        r_date=d,
         note=(note or None),
     )
     db.add(obj)
-    db.commit()
-    db.refresh(obj)
+    # 调用方只是记完跳回首页，不用再 refresh 多发一条 SELECT 把整行读回来
+    await db.commit()
+    mark_records_changed()
     return obj
 
 
-def delete_record(db: Session, user_id: int, record_id: int) -> bool:
-    obj = (
-        db.query(Record)
-        .filter(Record.id == record_id, Record.user_id == user_id)
-        .first()
+async def bulk_create_records(db: AsyncSession, user_id: int, rows: List[Dict[str, Any]]) -> int:
+    # 一个事务、一条 INSERT：SQLAlchemy 2.0 的 insertmanyvalues 会把多行拼成批量 VALUES，
+    # 不是逐行 add/flush；rows 里的键就是 Record 的列名
+    if not rows:
+        return 0
+    await db.execute(insert(Record), [dict(r, user_id=user_id) for r in rows])
+    await db.commit()
+    mark_records_changed()
+    return len(rows)
+
+
+async def delete_record(db: AsyncSession, user_id: int, record_id: int) -> bool:
+    # 直接一条 DELETE ... WHERE id=? AND user_id=?，不先 SELECT 出 ORM 对象再删
+    result = await db.execute(
+        delete(Record)
+        .where(Record.id == record_id, Record.user_id == user_id)
+        .execution_options(synchronize_session=False)
     )
-    if not obj:
-        return False
-    db.delete(obj)
-    db.commit()
-    return True
+    await db.commit()
+    if result.rowcount:
+        mark_records_changed()
+    return result.rowcount > 0
+
+
+async def home_bundle(
+    db: AsyncSession, user_id: int, start: date, end: date, limit: int = 200, fresh: bool = False
+) -> Tuple[List[Row], Dict[str, Decimal]]:
+    # 没有新写入时连续刷新首页，直接用上次的结果（调用方只读）；
+    # fresh=True 跳过读缓存（刚写完，这个进程的缓存可能还不知道那次写入），查完照样回填
+    key = (user_id, start, end, limit, _data_version)
+    bundle = None if fresh else _cache_get(_HOME_CACHE, key, HOME_CACHE_TTL)
+    if bundle is None:
+        bundle = await _home_bundle_query(db, user_id, start, end, limit)
+        _cache_put(_HOME_CACHE, key, bundle, HOME_CACHE_SIZE)
+    return bundle
+
+
+async def _home_bundle_query(
+    db: AsyncSession, user_id: int, start: date, end: date, limit: int
+) -> Tuple[List[Row], Dict[str, Decimal]]:
+    # 一条 SQL 拿到首页的列表和 [start, end] 的汇总
+    rows = (await db.execute(
+        _HOME_STMT, {"uid": user_id, "start": start, "end": end, "lim": limit}
+    )).all()
+    # 列表为空说明这个用户一条记录都没有，汇总自然是 0；两边都是两位小数的 Decimal，相减也是精确的
+    expense = rows[0].sum_expense if rows else _ZERO
+    income = rows[0].sum_income if rows else _ZERO
+    return rows, {"expense": expense, "income": income, "balance": income - expense}
 
 
 # ---------- Time helpers ----------
+# 纯函数、输入就是 "YYYY-MM" / "YYYY-Www" 这种字符串，返回不可变的 (date, date)：
+# 统计页反复看同几个月/周，缓存后就是一次字典查找
+@lru_cache(maxsize=4096)
 def month_range(yyyy_mm: str) -> Tuple[date, date]:
     y, m = yyyy_mm.split("-")
     y, m = int(y), int(m)
@@ -81,6 +247,7 @@ def month_range(yyyy_mm: str) -> Tuple[date, date]:
     return start, end
 
 
+@lru_cache(maxsize=4096)
 def week_range(yyyy_w: str) -> Tuple[date, date]:
     # input type="week" gives "YYYY-Www"
     y, w = yyyy_w.split("-W")
@@ -91,60 +258,47 @@ def week_range(yyyy_w: str) -> Tuple[date, date]:
 
 
 # ---------- Aggregations ----------
-def range_summary(db: Session, user_id: int, start: date, end: date) -> Dict[str, float]:
-    rows = (
-        db.query(Record.type, func.sum(Record.amount))
-        .filter(Record.user_id == user_id, Record.date >= start, Record.date <= end)
-        .group_by(Record.type)
-        .all()
-    )
-
-    expense = 0.0
-    income = 0.0
-    for t, s in rows:
-        if s is None:
-            continue
-        if t == "expense":
-            expense = float(s)
-        elif t == "income":
-            income = float(s)
-
-    return {
-        "expense": round(expense, 2),
-        "income": round(income, 2),
-        "balance": round(income - expense, 2),
-    }
+# 统计页：一条 GROUP BY r_type, category 同时给出两边的品类明细和总额
+_STATS_STMT = (
+    select(Record.r_type, Record.category, func.sum(Record.amount).label("total"))
+    .where(*_RANGE_FILTER)
+    .group_by(Record.r_type, Record.category)
+    .order_by(desc(func.sum(Record.amount)))
+)
 
 
-def category_breakdown(db: Session, user_id: int, start: date, end: date, type_: str) -> List[Dict[str, Any]]:
-    rows = (
-        db.query(Record.category, func.sum(Record.amount).label("total"))
-        .filter(
-            Record.user_id == user_id,
-            Record.type == type_,
-            Record.date >= start,
-            Record.date <= end,
-        )
-        .group_by(Record.category)
-        .order_by(desc(func.sum(Record.amount)))
-        .all()
-    )
-    return [{"category": (c or "未分类"), "total": float(t or 0.0)} for c, t in rows]
-    
-from sqlalchemy.orm import Session
-from typing import Optional, List
-from app.models import User
+async def stats_bundle(
+    db: AsyncSession, user_id: int, start: date, end: date, fresh: bool = False
+) -> Dict[str, Any]:
+    # 同一个区间在没有新写入时反复被看：直接返回上次算好的结果（调用方只读，不要改它）；fresh 同 home_bundle
+    key = (user_id, start, end, _data_version)
+    data = None if fresh else _cache_get(_STATS_CACHE, key, STATS_CACHE_TTL)
+    if data is None:
+        data = await _stats_bundle_query(db, user_id, start, end)
+        _cache_put(_STATS_CACHE, key, data, STATS_CACHE_SIZE)
+    return data
 
-def list_users(db: Session, limit: int = 200) -> List[User]:
-    return db.query(User).order_by(User.id.desc()).limit(limit).all()
 
-def get_user_by_username(db: Session, username: str) -> Optional[User]:
-    return db.query(User).filter(User.username == username).first()
+async def _stats_bundle_query(db: AsyncSession, user_id: int, start: date, end: date) -> Dict[str, Any]:
+    rows = (await db.execute(_STATS_STMT, {"uid": user_id, "start": start, "end": end})).all()
 
-def update_user_password(db: Session, user_id: int, password_hash: str) -> None:
-    u = db.query(User).filter(User.id == user_id).first()
-    if not u:
-        return
-    u.password_hash = password_hash
-    db.commit()
+    # SQL 已按金额倒序，分到两个列表里顺序不变；总额顺手累加。
+    # SUM(Numeric(12,2)) 取回来就是两位小数的 Decimal，全程不转 float，加减都是精确的
+    cats: Dict[str, List[Dict[str, Any]]] = {"expense": [], "income": []}
+    sums = {"expense": _ZERO, "income": _ZERO}
+    for t, c, total in rows:
+        if t not in cats:
+            continue
+        total = total or _ZERO
+        cats[t].append({"category": (c or "未分类"), "total": total})
+        sums[t] += total
 
+    return {
+        "summary": {
+            "expense": sums["expense"],
+            "income": sums["income"],
+            "balance": sums["income"] - sums["expense"],
+        },
+        "expense_categories": cats["expense"],
+        "income_categories": cats["income"],
+    }
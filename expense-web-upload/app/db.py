@@ -1,30 +1,76 @@
 # expense-web-upload/app/db.py
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 
 def _normalize_database_url(url: str) -> str:
     # Render 常给 postgres://，SQLAlchemy 需要 postgresql:// 或带 driver
     if url.startswith("postgres://"):
         url = url.replace("postgres://", "postgresql+psycopg://", 1)
     # 有些人手动配 postgresql://，也统一成 psycopg 驱动
-    if url.startswith("postgresql://") and "+psycopg" not in url and "+psycopg2" not in url:
+    if url.startswith("postgresql://") and "+psycopg" not in url:
         url = url.replace("postgresql://", "postgresql+psycopg://", 1)
+    # 现在走 async 引擎：psycopg2 不支持 asyncio，换成同样支持 async 的 psycopg3
+    if url.startswith("postgresql+psycopg2://"):
+        url = url.replace("postgresql+psycopg2://", "postgresql+psycopg://", 1)
+    # 本地 SQLite 用 aiosqlite 驱动
+    if url.startswith("sqlite://"):
+        url = url.replace("sqlite://", "sqlite+aiosqlite://", 1)
     return url
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./local.db")
 DATABASE_URL = _normalize_database_url(DATABASE_URL)
 
 connect_args = {}
+engine_kwargs = {}
 if DATABASE_URL.startswith("sqlite"):
     connect_args = {"check_same_thread": False}
+    # sqlite:// 和 sqlite:///:memory: 都是内存库（database 为空或 :memory:）
+    if make_url(DATABASE_URL).database not in (None, "", ":memory:"):
+        # aiosqlite 默认是 NullPool：每个请求都新开一个连接（外加一个后台线程）、重跑一遍 PRAGMA。
+        # 文件库改成连接池复用；:memory: 库每个连接是独立的库，不能这么用
+        engine_kwargs = {"poolclass": AsyncAdaptedQueuePool, "pool_size": 5, "max_overflow": 10}
+else:
+    engine_kwargs = {
+        # 突发并发时默认的 5+10 不够用；按数据库的 max_connections / worker 数用环境变量调
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "20")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "40")),
+        # LIFO：优先复用刚还回来的热连接，空闲多的连接自然被回收
+        "pool_use_lifo": True,
+        # 不再每次借连接都先发一条 SELECT 1 探活，改成连接用满 30 分钟就换新的；
+        # 如果线上数据库会更早掐掉空闲连接，设 DB_PRE_PING=1 把探活打开
+        "pool_recycle": 1800,
+        "pool_pre_ping": os.getenv("DB_PRE_PING", "") == "1",
+    }
+    if DATABASE_URL.startswith("postgresql+psycopg://"):
+        # psycopg3：同一条 SQL 执行 5 次后自动转成服务端 prepared statement，省掉重复的解析/规划
+        connect_args = {"prepare_threshold": 5}
 
-engine = create_engine(
+# async 引擎：路由里 await 数据库 IO 时事件循环可以去处理别的请求，不再一请求占一个线程
+engine = create_async_engine(
     DATABASE_URL,
     connect_args=connect_args,
-    pool_pre_ping=True,
+    **engine_kwargs,
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine.sync_engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL：提交只需一次 fsync，读写也不再互相阻塞
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        # 临时表/排序放内存；读走 mmap（256MB），少一次从页缓存拷到用户态
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA mmap_size=268435456")
+        # SQLite 默认不执行外键；打开后删用户时 ON DELETE CASCADE 才会生效（User.records 是 passive_deletes）
+        cur.execute("PRAGMA foreign_keys=ON")
+        cur.close()
+
+# async 下 commit 后再访问过期属性会触发隐式 IO（直接报错），所以不在 commit 时过期对象
+SessionLocal = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
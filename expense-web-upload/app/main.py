@@ -1,114 +1,280 @@
 # expense-web-upload/app/main.py
+import math
 import os
-from datetime import datetime, date
+import re
+from datetime import date
 from pathlib import Path
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, Request, Form, Depends, HTTPException
-from fastapi.responses import RedirectResponse, HTMLResponse, JSONResponse
+from fastapi import FastAPI, Request, Body, Depends, HTTPException
+from fastapi.responses import RedirectResponse, HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-
-from sqlalchemy.orm import Session
-from sqlalchemy import select, func
-
-from passlib.context import CryptContext
-
-from .db import SessionLocal, engine
+from starlette.routing import Route
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
+from sqlalchemy.orm import configure_mappers
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from . import crud
+from .auth import hash_password_async
+from .db import Base, SessionLocal, engine
 from .models import User, Record
-from .models import User, Record
-from .db import Base
 
 # ---------- App ----------
-app = FastAPI()
+# JSON 统一走 orjson（C 扩展，直接写 bytes），比标准库 json 快得多
+app = FastAPI(default_response_class=ORJSONResponse)
 
 BASE_DIR = Path(__file__).resolve().parent
 TEMPLATES_DIR = BASE_DIR / "templates"
 STATIC_DIR = BASE_DIR / "static"
 
 # static
+class CachedStatic(StaticFiles):
+    # 让浏览器缓存静态资源，之后的页面访问不再回源到 Python
+    async def get_response(self, path, scope):
+        r = await super().get_response(path, scope)
+        if r.status_code == 200:
+            if path.endswith("sw.js"):
+                # Service Worker 脚本必须每次校验，否则更新发不出去
+                r.headers["Cache-Control"] = "no-cache"
+            else:
+                # 文件名不带内容哈希（icons/ 也是），换图标后要能在一天内生效，不能标 immutable
+                r.headers["Cache-Control"] = "public, max-age=86400"
+        return r
+
+
 if STATIC_DIR.exists():
-    app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
+    app.mount("/static", CachedStatic(directory=str(STATIC_DIR)), name="static")
+
+# 整个进程共用一个 Jinja Environment：编译好的模板留在它的 LRU（cache_size）里，
+# 编译结果还落盘，worker 重启后也不用重新解析。
+# 线上模板不会改，不用每次渲染都 stat 一遍文件；本地调模板时设 DEBUG=1 打开自动重载
+DEBUG = os.getenv("DEBUG", "") == "1"
+
+jinja_env = Environment(
+    loader=FileSystemLoader(str(TEMPLATES_DIR)),
+    autoescape=True,
+    auto_reload=DEBUG,
+    cache_size=400,
+    # 不指定目录：Jinja 自己在临时目录下建按 uid 区分、权限 0700 的缓存目录并检查属主，
+    # 别人没法预先建好目录塞进被反序列化执行的字节码
+    bytecode_cache=FileSystemBytecodeCache(),
+)
+
 
-templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
+def _money(v) -> str:
+    # 金额只在模板真正输出时才格式化；None 当 0 处理
+    return format(v if v is not None else 0, ",.2f")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+jinja_env.filters["money"] = _money
+
+# 页面模板在 import 时就编译好拿在手里：渲染时不再按名字查 Environment 缓存 / 问 loader，
+# 第一个请求也不用现场解析；也不经过 TemplateResponse 再拷一遍 context
+INDEX_TPL = jinja_env.get_template("index.html")
+STATS_TPL = jinja_env.get_template("stats.html")
+
+
+def _render(tpl, context: dict) -> HTMLResponse:
+    if DEBUG:
+        # 调模板时每次重新取，改了文件能立刻看到
+        tpl = jinja_env.get_template(tpl.name)
+    return HTMLResponse(tpl.render(context))
 
 
 # ---------- DB ----------
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-@app.on_event("startup")
-def on_startup():
+def _init_schema(conn):
     # 自动建表（防止你第一次就 500）
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=conn)
+    # create_all 不会给已存在的表补索引，这里单独补一次
+    for idx in Record.__table__.indexes:
+        idx.create(bind=conn, checkfirst=True)
+
+
+# 多 worker 部署或已经用迁移管理表结构时，设 RUN_DB_INIT=0 跳过启动时的建表/补索引
+RUN_DB_INIT = os.getenv("RUN_DB_INIT", "1") == "1"
+
+
+@app.on_event("startup")
+async def on_startup():
+    # 关系映射在启动时就配置好，不留给第一个请求的第一条 ORM 查询去做
+    configure_mappers()
+    if not RUN_DB_INIT:
+        return
+    async with engine.begin() as conn:
+        await conn.run_sync(_init_schema)
 
 
 # ---------- Helpers ----------
-def get_or_create_demo_user(db: Session) -> User:
-    u = db.execute(select(User).where(User.username == "demo")).scalar_one_or_none()
-    if u:
-        return u
-    demo = User(username="demo", password_hash=pwd_context.hash("demo123456"))
-    db.add(demo)
-    db.commit()
-    db.refresh(demo)
-    return demo
+DEMO_USERNAME = "demo"
+
+# demo 用户的 id 进程内只查一次，之后的请求不再为它访问数据库
+_DEMO_UID: Optional[int] = None
+
+
+def _insert(table):
+    # INSERT ... ON CONFLICT DO NOTHING 是方言专属的写法
+    if engine.dialect.name == "postgresql":
+        return pg_insert(table)
+    return sqlite_insert(table)
+
+
+async def get_demo_user_id(db: AsyncSession) -> int:
+    global _DEMO_UID
+    if _DEMO_UID is not None:
+        return _DEMO_UID
 
+    # 绝大多数时候 demo 用户早就在库里：先查 id，查到就不用算 PBKDF2
+    uid = (await db.execute(select(User.id).where(User.username == DEMO_USERNAME))).scalar_one_or_none()
+    if uid is None:
+        # 一条语句完成“没有就建”，并发的首个请求也不会撞唯一约束
+        uid = (await db.execute(
+            _insert(User)
+            .values(username=DEMO_USERNAME, password_hash=await hash_password_async("demo123456"))
+            .on_conflict_do_nothing(index_elements=["username"])
+            .returning(User.id)
+        )).scalar_one_or_none()
+        if uid is None:
+            uid = (await db.execute(select(User.id).where(User.username == DEMO_USERNAME))).scalar_one()
+        await db.commit()
 
+    _DEMO_UID = uid
+    return uid
+
+
+_DATE_RE = re.compile(r"^(\d{4})[-/](\d{1,2})[-/](\d{1,2})$")
+
+
+@lru_cache(maxsize=4096)
 def parse_date_str(s: str) -> date:
-    # 接受 YYYY-MM-DD
-    return datetime.strptime(s, "%Y-%m-%d").date()
+    # 接受 YYYY-MM-DD（也兼容 YYYY/MM/DD）；不用 strptime，省掉它每次解释格式串的开销。
+    # 记账日期来来回回就那几天，结果（不可变的 date）按原字符串缓存
+    s = s.strip()
+    # <input type="date"> 提交的永远是定长的 YYYY-MM-DD：交给 C 实现的 fromisoformat，连正则都不用
+    if len(s) == 10 and s[4] == "-" and s[7] == "-":
+        return date.fromisoformat(s)
+    m = _DATE_RE.match(s)
+    if not m:
+        raise ValueError(f"invalid date: {s!r}")
+    return date(int(m[1]), int(m[2]), int(m[3]))
+
+
+# 写入之后给客户端种一个短命 cookie：多 worker 时跳回来的请求可能落在别的进程上，
+# 那边的缓存 / ETag 还不知道这次写入。cookie 有效期内页面不回 304、也不读缓存，保证能看到自己刚写的数据
+FRESH_COOKIE = "xz_fresh"
+FRESH_SECONDS = math.ceil(max(crud.HOME_CACHE_TTL, crud.STATS_CACHE_TTL))
+
+
+def _mark_fresh(resp: Response) -> Response:
+    if FRESH_SECONDS > 0:
+        resp.set_cookie(FRESH_COOKIE, "1", max_age=FRESH_SECONDS, httponly=True, samesite="lax")
+    return resp
+
+
+def _page_etag(key: str, ttl: float) -> Optional[str]:
+    # 对应的缓存关掉（ttl=0）时没有 ETag
+    tag = crud.data_tag(ttl)
+    return f'W/"{key}-{tag}"' if tag is not None else None
+
+
+def _not_modified(request: Request, etag: Optional[str]) -> bool:
+    # If-None-Match 可能带多个（逗号分隔）；命中任意一个就回 304
+    if etag is None:
+        return False
+    inm = request.headers.get("if-none-match")
+    return inm is not None and etag in (t.strip() for t in inm.split(","))
 
 
 # ---------- Health ----------
-@app.get("/health")
-def health():
-    return {"ok": True}
+# 探活响应只建这一份：下面的路由和 app_wrap 都直接发它
+_HEALTH_RESP = Response(b'{"ok":true}', media_type="application/json")
+
+
+async def health(request: Request):
+    return _HEALTH_RESP
+
+
+# 裸的 Starlette Route，插在路由表最前面：不走 FastAPI 的依赖解析和响应序列化，
+# 响应对象也是提前建好的（直接跑 app.main:app、不经过下面的 app_wrap 时用得上）
+app.router.routes.insert(0, Route("/health", health, methods=["GET"]))
+
+
+if DEBUG:
+    # 连接池占用情况（checked out / overflow），排查池子打满时看这个；
+    # 暴露的是内部状态、又不用登录，只在 DEBUG=1 时注册
+    @app.get("/health/pool")
+    async def health_pool():
+        return {"ok": True, "pool": engine.pool.status()}
+
+
+# 负载均衡探活很频繁：在进 FastAPI 之前就直接回包，不走路由匹配 / 依赖解析。
+# 上面的 /health 路由留着，直接跑 app.main:app 时照样能用
+async def app_wrap(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == "/health":
+        await _HEALTH_RESP(scope, receive, send)
+        return
+    await app(scope, receive, send)
 
 
 # ---------- Pages ----------
 @app.get("/", response_class=HTMLResponse)
-def home(request: Request, db: Session = Depends(get_db)):
-    user = get_or_create_demo_user(db)
-
-    rows = db.execute(
-        select(Record)
-        .where(Record.user_id == user.id)
-        .order_by(Record.r_date.desc(), Record.id.desc())
-        .limit(200)
-    ).scalars().all()
-
-    return templates.TemplateResponse(
-        "index.html",
-        {"request": request, "records": rows, "username": user.username},
+async def home(request: Request, db: AsyncSession = Depends(get_db)):
+    user_id = await get_demo_user_id(db)
+
+    # 数据没变就 304：日期也在 key 里，跨天（换月）自然失效。刚写过数据的客户端不走 304 / 缓存
+    today = date.today()
+    fresh = FRESH_COOKIE in request.cookies
+    etag = None if fresh else _page_etag(f"home-{user_id}-{today}", crud.HOME_CACHE_TTL)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # 列表 + 本月汇总一次往返拿回来；汇总在 SQL 里聚合，不依赖那 200 条列表（本月超过 200 条也算得对）
+    rows, summary = await crud.home_bundle(db, user_id, today.replace(day=1), today, limit=200, fresh=fresh)
+    # 数据都拿到了（Row / Decimal，不依赖 session）：先把连接还给池子再渲染
+    await db.close()
+
+    resp = _render(
+        INDEX_TPL,
+        {
+            "records": rows,
+            "username": DEMO_USERNAME,
+            # 原样传 Decimal，格式化交给模板里的 |money
+            "total_expense": summary["expense"],
+            "total_income": summary["income"],
+            "balance": summary["balance"],
+        },
     )
+    if etag:
+        resp.headers["ETag"] = etag
+    # 不给 max-age：记完一笔 303 跳回首页时浏览器必须回来校验（多 worker 时再靠 FRESH_COOKIE 绕过缓存）
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 
 @app.get("/add", response_class=HTMLResponse)
-def add_page(request: Request):
+async def add_page(request: Request):
     # 你如果没有 add.html，就继续用 index.html 里表单也行
     # 这里给个简单兜底页面：直接重定向回首页
     return RedirectResponse(url="/", status_code=303)
 
 
-@app.post("/add")
-def add_record(
-    r_type: str = Form(...),
-    date_str: str = Form(...),
-    amount: str = Form(...),
-    category: str = Form("其他"),
-    note: str = Form(""),
-    db: Session = Depends(get_db),
-):
-    user = get_or_create_demo_user(db)
+_CENT = Decimal("0.01")
+# Record.amount 是 Numeric(12, 2)：整数部分最多 10 位
+AMOUNT_MAX = Decimal("9999999999.99")
 
+
+def _clean_record(r_type: str, date_str: str, amount: str, category: str, note: str) -> Dict[str, Any]:
+    # 表单和批量接口共用的校验/清洗，返回可以直接写进 Record 的列
     r_type = r_type.strip().lower()
     if r_type not in ("expense", "income"):
         raise HTTPException(status_code=400, detail="r_type must be expense or income")
@@ -122,48 +288,154 @@ def add_record(
         amt = Decimal(amount.strip())
     except Exception:
         raise HTTPException(status_code=400, detail="amount must be a number")
+    # Decimal 认 NaN / Infinity / 1e20 这类值：写库要么撞 NOT NULL，要么让 Numeric(12,2) 溢出，这里先挡掉
+    if not amt.is_finite() or amt < 0:
+        raise HTTPException(status_code=400, detail="amount must be a non-negative number")
+    try:
+        amt = amt.quantize(_CENT, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise HTTPException(status_code=400, detail="amount is too large")
+    if amt > AMOUNT_MAX:
+        raise HTTPException(status_code=400, detail=f"amount must not exceed {AMOUNT_MAX}")
+
+    return {
+        "r_type": r_type,
+        "r_date": r_date,
+        "amount": amt,
+        "category": (category or "其他").strip()[:50],
+        "note": (note or "").strip()[:200],
+    }
+
+
+def _normalize_payload(d) -> Dict[str, Any]:
+    # 字段别名：首页表单提交的是 type / date，接口和旧表单用 r_type / date_str，两种都认。
+    # 别名就这几个，直接写成 or 链，一次 dict 查找命中就短路
+    return _clean_record(
+        str(d.get("r_type") or d.get("type") or ""),
+        str(d.get("date_str") or d.get("date") or ""),
+        str(d.get("amount", "")),
+        str(d.get("category") or "其他"),
+        str(d.get("note") or ""),
+    )
 
-    category = (category or "其他").strip()[:50]
-    note = (note or "").strip()[:200]
 
-    rec = Record(
-        user_id=user.id,
-        r_type=r_type,
-        r_date=r_date,
-        amount=amt,
-        category=category,
-        note=note,
+@app.post("/add")
+async def add_record(request: Request, db: AsyncSession = Depends(get_db)):
+    # body 只解析一次：JSON 就读 JSON，否则按表单读；不再声明一串 Form(...) 参数让 FastAPI 先解析一遍
+    is_json = request.headers.get("content-type", "").startswith("application/json")
+    if is_json:
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid JSON body")
+        if not isinstance(payload, dict):
+            raise HTTPException(status_code=400, detail="JSON body must be an object")
+    else:
+        payload = await request.form()
+    fields = _normalize_payload(payload)
+
+    user_id = await get_demo_user_id(db)
+    # 和其它写入共用 crud.create_record：提交后在那里统一让缓存失效
+    rec = await crud.create_record(
+        db, user_id, fields["r_type"], fields["amount"], fields["category"], fields["r_date"], fields["note"]
     )
-    db.add(rec)
-    db.commit()
 
-    return RedirectResponse(url="/", status_code=303)
+    if is_json:
+        return _mark_fresh(ORJSONResponse({"ok": True, "id": rec.id}))
+    return _mark_fresh(RedirectResponse(url="/", status_code=303))
+
+
+BULK_MAX_ROWS = 5000
+
+
+@app.post("/api/records/bulk")
+async def add_records_bulk(
+    payload: List[Dict[str, Any]] = Body(...),
+    db: AsyncSession = Depends(get_db),
+):
+    # 批量导入：[{r_type, date_str, amount, category?, note?}, ...]，字段和 /add 一样（也认 type / date）；
+    # 全部校验通过才写，一个事务一次插入，有一条不合法就整批 400
+    if len(payload) > BULK_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"at most {BULK_MAX_ROWS} records per request")
+
+    rows = []
+    for i, item in enumerate(payload):
+        try:
+            rows.append(_normalize_payload(item))
+        except HTTPException as e:
+            raise HTTPException(status_code=400, detail=f"[{i}] {e.detail}")
+
+    user_id = await get_demo_user_id(db)
+    inserted = await crud.bulk_create_records(db, user_id, rows)
+    return _mark_fresh(ORJSONResponse({"ok": True, "inserted": inserted}))
+
+
+# ---------- Stats (按月 / 按周) ----------
+@lru_cache(maxsize=2)
+def _default_periods(today: date) -> Tuple[str, str]:
+    # 当天默认的 "YYYY-MM" 和 "YYYY-Www"：一天只算一次（maxsize=2 够跨零点时新旧两天并存）
+    iso_year, iso_week, _ = today.isocalendar()
+    return f"{today.year}-{today.month:02d}", f"{iso_year}-W{iso_week:02d}"
+
+
+@lru_cache(maxsize=512)
+def _stats_period(mode: str, month_value: str, week_value: str) -> Tuple[date, date, Dict[str, Any]]:
+    # 只由参数决定的部分：起止日期 + 模板里和数据无关的那几项（标题、表单回填值）。
+    # 返回的 dict 是共享的，调用方只能读；非法参数抛 ValueError（不会被缓存）
+    if mode == "week":
+        start, end = crud.week_range(week_value)
+        label = f"{week_value}（{start} ~ {end}）"
+    else:
+        mode = "month"
+        start, end = crud.month_range(month_value)
+        label = f"{month_value}（{start} ~ {end}）"
+    return start, end, {
+        "username": DEMO_USERNAME,
+        "mode": mode,
+        "month_value": month_value,
+        "week_value": week_value,
+        "label": label,
+    }
 
 
-# ---------- Simple stats (先兜底，后面你要月/周我再按你的页面结构接上) ----------
 @app.get("/stats", response_class=HTMLResponse)
-def stats_page(request: Request, db: Session = Depends(get_db)):
-    user = get_or_create_demo_user(db)
-
-    # 按月聚合
-    # Postgres: date_trunc('month', r_date)
-    month_bucket = func.date_trunc("month", Record.r_date).label("bucket")
-
-    rows = db.execute(
-        select(
-            month_bucket,
-            Record.r_type,
-            func.coalesce(func.sum(Record.amount), 0).label("total"),
-        )
-        .where(Record.user_id == user.id)
-        .group_by(month_bucket, Record.r_type)
-        .order_by(month_bucket.desc(), Record.r_type)
-    ).all()
-
-    return templates.TemplateResponse(
-        "stats.html",
-        {"request": request, "rows": rows, "username": user.username},
-    )
+async def stats_page(
+    request: Request,
+    mode: str = "month",
+    month: str = "",
+    week: str = "",
+    db: AsyncSession = Depends(get_db),
+):
+    user_id = await get_demo_user_id(db)
+
+    # 默认值按天缓存，没传参时也不用每次 isocalendar / 格式化
+    default_month, default_week = _default_periods(date.today())
+    month_value = month.strip() or default_month
+    week_value = week.strip() or default_week
+
+    # 月/周的起止日期在 Python 里算好，SQL 里只剩 r_date 上的范围过滤：
+    # 能直接走 (user_id, r_date) 索引，不再对每行套 date_trunc 再分组
+    try:
+        start, end, static_ctx = _stats_period(mode, month_value, week_value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM, week must be YYYY-Www")
+
+    # 数据没变（同一区间、同一数据版本）就直接 304：不查库、不渲染、不传 body
+    fresh = FRESH_COOKIE in request.cookies
+    etag = None if fresh else _page_etag(f"stats-{user_id}-{static_ctx['mode']}-{start}-{end}", crud.STATS_CACHE_TTL)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    # 汇总 + 两边品类明细：一次 GROUP BY r_type, category 全部拿到
+    data = await crud.stats_bundle(db, user_id, start, end, fresh=fresh)
+    await db.close()
+
+    resp = _render(STATS_TPL, {**static_ctx, **data})
+    if etag:
+        resp.headers["ETag"] = etag
+    # 允许浏览器缓存，但每次都带 If-None-Match 回来校验
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 
 # ---------- Better error visibility ----------
@@ -171,7 +443,7 @@ def stats_page(request: Request, db: Session = Depends(get_db)):
 async def global_exception_handler(request: Request, exc: Exception):
     # Render 上你看到 Internal Server Error，这里让你至少能看到更明确的错误
     # 生产环境你可以改成隐藏细节
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"error": "Internal Server Error", "detail": str(exc)},
     )
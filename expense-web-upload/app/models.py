@@ -1,5 +1,5 @@
 # expense-web-upload/app/models.py
-from sqlalchemy import Column, Integer, String, Date, DateTime, Numeric, ForeignKey, func
+from sqlalchemy import Column, Integer, String, Date, DateTime, Numeric, ForeignKey, Index, func
 from sqlalchemy.orm import relationship
 from .db import Base
 
@@ -11,16 +11,22 @@ class User(Base):
     password_hash = Column(String(255), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    records = relationship("Record", back_populates="user", cascade="all, delete-orphan")
+    # 关系一律不隐式懒加载（async 下隐式 IO 本来也会直接报错），要用就在查询里显式 selectinload；
+    # passive_deletes：删用户时交给数据库的 ON DELETE CASCADE，不先把他的所有记录 SELECT 出来
+    records = relationship(
+        "Record", back_populates="user", cascade="all, delete-orphan", lazy="raise", passive_deletes=True
+    )
 
 class Record(Base):
     __tablename__ = "records"
 
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    # user_id / r_type / r_date 不再单独建索引：所有查询都是 user_id 打头，
+    # 下面两个复合索引已经覆盖（也覆盖按 user_id 级联删除），单列索引只会拖慢写入
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
 
     # r_type: "expense" / "income"
-    r_type = Column(String(10), nullable=False, index=True)
+    r_type = Column(String(10), nullable=False)
 
     # 分类（品类）
     category = Column(String(50), nullable=False, default="其他")
@@ -29,9 +35,17 @@ class Record(Base):
     note = Column(String(200), nullable=True)
 
     # 记账日期
-    r_date = Column(Date, nullable=False, index=True)
+    r_date = Column(Date, nullable=False)
 
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    user = relationship("User", back_populates="records")
+    user = relationship("User", back_populates="records", lazy="raise")
+
+    __table_args__ = (
+        # 首页列表：WHERE user_id=? ORDER BY r_date DESC, id DESC LIMIT n，直接走索引顺序
+        Index("ix_record_user_date_id", "user_id", r_date.desc(), id.desc()),
+        # 统计/汇总：WHERE user_id=? AND r_date 范围，GROUP BY r_type, category，SUM(amount)。
+        # 用到的列全在索引里，Postgres 可以只扫索引不回表
+        Index("ix_record_user_date_type_cat", "user_id", "r_date", "r_type", "category", "amount"),
+    )
 
@@ -1,2 +1,2 @@
-uvicorn app.main:app --host 0.0.0.0 --port ${PORT:-10000}
+uvicorn app.main:app_wrap --host 0.0.0.0 --port ${PORT:-10000} --loop auto --http auto --backlog 4096 --limit-concurrency 1024 --timeout-keep-alive 15
 